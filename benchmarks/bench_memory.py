@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2013 Zhiqiang Fan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark memory per queued url and per page record.
+
+Links found in pages are new unicode objects, so a url linked from k
+pages used to be queued as k (url, depth) tuples holding k copies of
+the url. Task records share one interned string per url instead.
+Sizes are counted with sys.getsizeof, every object counted only once.
+
+usage: bench_memory.py [unique urls] [links per url]
+"""
+
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'spider'))
+from spider import Task, Page
+
+
+def deep_size(items, attrs):
+    """Return bytes of items and their attrs, shared objects once."""
+    seen = set()
+    total = 0
+    for item in items:
+        objs = [item] + [attr(item) for attr in attrs]
+        for obj in objs:
+            if id(obj) not in seen:
+                seen.add(id(obj))
+                total += sys.getsizeof(obj)
+    return total
+
+
+def discovered_urls(unique, links):
+    """Yield urls as parsed from pages, a new object for every link."""
+    for i in range(links):
+        for j in range(unique):
+            yield u''.join((u'http://www.example.com/news/2013/',
+                            u'item-%d.html' % j))
+
+
+def main(argv=sys.argv[1:]):
+    unique = int(argv[0]) if argv else 100000
+    links = int(argv[1]) if len(argv) > 1 else 4
+    count = unique * links
+    tuples = [(url, 1) for url in discovered_urls(unique, links)]
+    before = deep_size(tuples, (lambda t: t[0],))
+    del tuples
+    tasks = [Task(url, 1) for url in discovered_urls(unique, links)]
+    after = deep_size(tasks, (lambda t: t.url,))
+    del tasks
+    print 'queued urls: %d (%d unique)' % (count, unique)
+    print '(url, depth) tuple: %.1f bytes per url' % (1.0 * before / count)
+    print 'Task record: %.1f bytes per url' % (1.0 * after / count)
+    page = {'url': '', 'content': '', 'etag': '', 'lastmodified': '',
+            'redirect': ''}
+    print 'page dict: %d bytes' % sys.getsizeof(page)
+    print 'Page record: %d bytes' % sys.getsizeof(Page('', ''))
+
+
+if __name__ == '__main__':
+    main()
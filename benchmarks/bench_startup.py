@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (C) 2013 Zhiqiang Fan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmark time to import spider and to construct a Spider.
+
+Each round runs in a fresh interpreter, so module caches don't hide the
+import cost. Modules loaded by import are also listed, a heavy module
+showing up there means it's no longer loaded lazily.
+
+usage: bench_startup.py [rounds]
+"""
+
+import os
+import sys
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'spider')
+HEAVY_MODULES = ('urllib2', 'sqlite3', 'gzip', 'json', 'unittest',
+                 'BeautifulSoup', 'argparse', 'tempfile')
+
+ROUND = r"""
+import sys
+import time
+sys.path.insert(0, %r)
+t0 = time.time()
+import spider
+t1 = time.time()
+s = spider.Spider('http://localhost', loglevel=1, threads=10)
+t2 = time.time()
+s.logger.handlers = []
+heavy = [m for m in %r if m in sys.modules]
+print '%%f %%f %%s' %% (t1 - t0, t2 - t1, ','.join(heavy))
+"""
+
+
+def run_round():
+    """Return (import seconds, startup seconds, heavy modules)."""
+    code = ROUND % (SOURCE_DIR, HEAVY_MODULES)
+    out = subprocess.check_output([sys.executable, '-c', code])
+    fields = out.split()
+    heavy = fields[2].split(',') if len(fields) > 2 else []
+    return float(fields[0]), float(fields[1]), heavy
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=sys.argv[1:]):
+    rounds = int(argv[0]) if argv else 10
+    results = [run_round() for i in range(rounds)]
+    imports = [r[0] * 1000 for r in results]
+    startups = [r[1] * 1000 for r in results]
+    print 'rounds: %d' % rounds
+    print 'import spider: min %.2fms median %.2fms' % (
+        min(imports), median(imports))
+    print 'Spider(): min %.2fms median %.2fms' % (
+        min(startups), median(startups))
+    print 'heavy modules loaded: %s' % (', '.join(results[0][2]) or 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,33 +17,74 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Simple Spider using coroutine to grab data from url."""
+"""Simple Spider using coroutine to grab data from url.
+
+Heavy modules (urllib2, sqlite3, gzip, BeautifulSoup, unittest...) are
+imported by the functions needing them, so importing this module and
+short runs only pay for what they use.
+"""
 
 import os
 import sys
 import re
 import copy
-import urllib2
-import sqlite3
+import urlparse
 import logging
-import unittest
-import gzip
-import StringIO
 import time
+import heapq
+from collections import deque
 from Queue import Queue
 from Queue import Empty
+from threading import Condition
+from threading import Lock
 from threading import Thread
 from threading import Timer
+from threading import local
+
+
+def intern_url(url):
+    """Return url interned, so equal urls share one string object.
+
+    Only byte strings can be interned, so an ascii unicode url is
+    encoded first, and the rare non-ascii url is returned as it is.
+    """
+    if isinstance(url, unicode):
+        try:
+            url = url.encode('ascii')
+        except UnicodeError:
+            return url
+    return intern(url)
+
+
+class Task(object):
+    """A url waiting to be crawled and the depth left for it."""
+    __slots__ = ('url', 'depth')
+
+    def __init__(self, url, depth):
+        self.url = intern_url(url)
+        self.depth = depth
+
 
-import gevent
-from gevent import monkey
+class Page(object):
+    """A crawled page on its way from get_page to the sink."""
+    __slots__ = ('url', 'content', 'etag', 'lastmodified', 'redirect')
 
-import argparse
-import BeautifulSoup
-import requests
+    def __init__(self, url, content, etag='', lastmodified='',
+                 redirect=''):
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.lastmodified = lastmodified
+        self.redirect = redirect
 
 
-#monkey.patch_all(dns=False)
+class Links(object):
+    """Out-links found in the page of url, an edge list of link graph."""
+    __slots__ = ('url', 'links')
+
+    def __init__(self, url, links):
+        self.url = url
+        self.links = links
 
 
 class TreadPoolSlot(Thread):
@@ -81,11 +122,13 @@ class TreadPool(object):
     tp.joinall()
     """
     def __init__(self, num):
-        """num: Max threads of this pool."""
+        """num: Max threads of this pool.
+
+        Threads are not started until the first func is spawned.
+        """
+        self.num = num
         self.tasks = Queue(num)
         self.pool = []
-        for i in range(num):
-            self.pool.append(TreadPoolSlot(self.tasks))
 
     def spawn(self, func, *args, **kwargs):
         """Spawn the func, note that it will not be start immediately.
@@ -93,6 +136,9 @@ class TreadPool(object):
         When a func is spawned, it will wait for a slot to run, or it
         will be blocked.
         """
+        if not self.pool:
+            self.pool.extend(TreadPoolSlot(self.tasks)
+                             for i in range(self.num))
         self.tasks.put((func, args, kwargs))
 
     def joinall(self):
@@ -120,23 +166,420 @@ class TreadPool(object):
         return r
 
 
-class SQLWorker(Thread):
-    def __init__(self,
-                 dbfile='/tmp/sample.db',
-                 in_queue=None,
-                 logger=None):
-        """SQLWorker init method.
+class FrontierQueue(object):
+    """FIFO queue of Task records which spills to disk.
 
-        param: dbfile where to store database, only sqlite3 support
-        param: in_queue where to get data
+    At most high_watermark tasks are kept in memory, once it is full,
+    new tasks are appended to a spill file instead. When the tasks in
+    memory drop to low_watermark, they are refilled from the spill
+    file, so the memory stays flat no matter how many links are found.
+    The FIFO order is kept across memory and disk.
+
+    If priority is given, tasks in memory are got by priority instead,
+    larger first and FIFO for the same priority. Spilled tasks are
+    still read back in FIFO order, so the priority only applies inside
+    the window of tasks in memory.
+
+    Only put, get and qsize of Queue.Queue are supported, put never
+    blocks because the disk is the buffer.
+    """
+    def __init__(self, high_watermark=10000, low_watermark=None,
+                 spill_dir=None, priority=None):
+        """FrontierQueue init method.
+
+        param: high_watermark Max tasks kept in memory
+        param: low_watermark Refill from disk when memory drops to it,
+                             half of high_watermark if None
+        param: spill_dir Where to create the spill file, system temp
+                         directory if None
+        param: priority Callable returns a list of numbers for a list of
+                        urls, evaluated when the task goes into memory
+
+        raise ValueError unless 0 <= low_watermark < high_watermark
+        """
+        if low_watermark is None:
+            low_watermark = high_watermark // 2
+        if high_watermark < 1:
+            raise ValueError('high watermark must be at least 1')
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError('low watermark must be in [0, %d)' %
+                             high_watermark)
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.spill_dir = spill_dir
+        self.priority = priority
+        # heap of (-priority, sequence, task) if priority is given
+        self.memory = [] if priority else deque()
+        self.sequence = 0
+        self.spilled = 0
+        self.spill_path = None
+        self.writer = None
+        self.reader = None
+        self.not_empty = Condition()
+
+    def put(self, item, block=True, timeout=None):
+        """Put a Task into the queue, block and timeout unused."""
+        score = None
+        # score before taking the lock, it may query a database
+        if self.priority:
+            score = self.priority([item.url])[0]
+        with self.not_empty:
+            # once something is on disk, new tasks must queue behind it
+            if self.spilled or len(self.memory) >= self.high_watermark:
+                self.spill(item)
+            else:
+                self.remember(item, score)
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return a Task, same as Queue.get."""
+        with self.not_empty:
+            if not block:
+                if not self.qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self.qsize():
+                    self.not_empty.wait()
+            else:
+                endtime = time.time() + timeout
+                while not self.qsize():
+                    remaining = endtime - time.time()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            if self.spilled and len(self.memory) <= self.low_watermark:
+                self.refill()
+            if self.priority:
+                return heapq.heappop(self.memory)[2]
+            return self.memory.popleft()
+
+    def remember(self, item, score=None):
+        """Keep a Task in memory, score is its priority if enabled."""
+        if self.priority:
+            self.sequence += 1
+            heapq.heappush(self.memory, (-score, self.sequence, item))
+        else:
+            self.memory.append(item)
+
+    def qsize(self):
+        """Return count of tasks both in memory and on disk."""
+        return len(self.memory) + self.spilled
+
+    def spill(self, item):
+        """Append a task to the spill file, one 'depth url' per line."""
+        if not self.writer:
+            import tempfile
+            fd, self.spill_path = tempfile.mkstemp(prefix='frontier-',
+                                                   suffix='.spill',
+                                                   dir=self.spill_dir)
+            self.writer = os.fdopen(fd, 'ab')
+            self.reader = open(self.spill_path, 'rb')
+        url = item.url
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        # a line break would corrupt the line based format
+        url = url.replace('\n', '%0A')
+        self.writer.write('%d %s\n' % (item.depth, url))
+        self.spilled += 1
+
+    def refill(self):
+        """Move spilled tasks back into memory up to high_watermark."""
+        self.writer.flush()
+        # seek to clear the EOF state, or new lines will not be seen
+        self.reader.seek(self.reader.tell())
+        count = min(self.spilled, self.high_watermark - len(self.memory))
+        tasks = []
+        for i in range(count):
+            depth, url = self.reader.readline().rstrip('\n').split(' ', 1)
+            tasks.append(Task(url.decode('utf-8'), int(depth)))
+        # score the whole refill with one call instead of one per task
+        scores = [None] * count
+        if self.priority:
+            scores = self.priority([task.url for task in tasks])
+        for task, score in zip(tasks, scores):
+            self.remember(task, score)
+        self.spilled -= count
+        # everything is read back, reclaim the disk space
+        if not self.spilled:
+            self.writer.truncate(0)
+            # reopen, seeking may keep serving the stale read buffer
+            self.reader.close()
+            self.reader = open(self.spill_path, 'rb')
+
+    def close(self):
+        """Remove the spill file."""
+        if self.writer:
+            self.writer.close()
+            self.reader.close()
+            os.remove(self.spill_path)
+            self.writer = None
+            self.reader = None
+
+
+class SeenSet(object):
+    """Set of crawled urls which spills to a sqlite file.
+
+    At most memory_size urls are kept in memory, once it is full, they
+    are moved into a table of a temporary sqlite file in one batch, so
+    the memory stays flat no matter how many urls are crawled. A url is
+    looked up in memory first, then on disk.
+
+    Only add, len and in of set are supported. It is not thread safe,
+    the sqlite connection belongs to the thread which spilled first.
+    """
+    def __init__(self, memory_size=100000, spill_dir=None):
+        """SeenSet init method.
+
+        param: memory_size Max urls kept in memory, at least 1
+        param: spill_dir Where to create the spill file, system temp
+                         directory if None
+        """
+        if memory_size < 1:
+            raise ValueError('memory size must be at least 1')
+        self.memory_size = memory_size
+        self.spill_dir = spill_dir
+        self.memory = set()
+        self.spilled = 0
+        self.spill_path = None
+        self.conn = None
+
+    def __contains__(self, url):
+        if url in self.memory:
+            return True
+        if not self.conn:
+            return False
+        curs = self.conn.execute('SELECT 1 FROM seen WHERE url=?;', (url,))
+        return curs.fetchone() is not None
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    def add(self, url):
+        """Add url, spill all urls in memory to disk once it's full.
+
+        Re-adding a spilled url is only noticed at the next spill, so
+        check with in first to keep len exact.
+        """
+        self.memory.add(url)
+        if len(self.memory) >= self.memory_size:
+            self.spill()
+
+    def spill(self):
+        """Move all urls in memory into the sqlite file."""
+        if not self.conn:
+            import sqlite3
+            import tempfile
+            fd, self.spill_path = tempfile.mkstemp(prefix='seen-',
+                                                   suffix='.db',
+                                                   dir=self.spill_dir)
+            os.close(fd)
+            self.conn = sqlite3.connect(self.spill_path)
+            self.conn.execute('CREATE TABLE seen(url PRIMARY KEY);')
+        curs = self.conn.executemany('INSERT OR IGNORE INTO seen VALUES (?);',
+                                     ((url,) for url in self.memory))
+        # url added again after being spilled is not counted twice
+        self.spilled += curs.rowcount
+        self.conn.commit()
+        self.memory = set()
+
+    def close(self):
+        """Remove the spill file."""
+        if self.conn:
+            self.conn.close()
+            os.remove(self.spill_path)
+            self.conn = None
+
+
+class Profiler(object):
+    """Cheap profiler to see where the crawling time goes.
+
+    Two sources are recorded: timing hooks wrapped around the stage
+    methods of an object, and a sampler thread which collects the
+    stacks of the watched threads every interval seconds. Nothing is
+    wrapped or started unless a profiler is created, so the original
+    methods run untouched when profiling is disabled.
+
+    Example:
+    profiler = Profiler()
+    profiler.wrap(spider, ('get_page', 'filter_links'))
+    profiler.watch(spider.pool.pool)
+    profiler.start()
+    ...
+    profiler.stop()
+    profiler.report('/tmp/spider.profile')
+    """
+    def __init__(self, interval=0.005):
+        """interval: Seconds between two stack samples."""
+        self.interval = interval
+        # stage name => [calls, total seconds]
+        self.timings = {}
+        # collapsed stack 'a;b;c' => samples
+        self.stacks = {}
+        self.threads = []
+        self.lock = Lock()
+        self.running = False
+        self.sampler = None
+
+    def wrap(self, obj, names):
+        """Replace methods of obj named in names with timed ones."""
+        for name in names:
+            setattr(obj, name, self.timed(name, getattr(obj, name)))
+
+    def timed(self, name, func):
+        """Return func wrapped by a timing hook named name."""
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(name, time.time() - start)
+        return wrapper
+
+    def record(self, name, elapsed):
+        """Add one call of stage name which takes elapsed seconds."""
+        with self.lock:
+            timing = self.timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+
+    def watch(self, threads):
+        """Sample stacks of threads, a list which may grow later."""
+        self.threads = threads
+
+    def start(self):
+        """Start the sampler thread."""
+        self.running = True
+        self.sampler = Thread(target=self.sample)
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def stop(self):
+        """Stop the sampler thread and wait for it."""
+        self.running = False
+        if self.sampler:
+            self.sampler.join()
+
+    def sample(self):
+        """Collect stacks of busy watched threads until stopped."""
+        while self.running:
+            frames = sys._current_frames()
+            for thread in list(self.threads):
+                # idle pool slot is just waiting for a task
+                if getattr(thread, 'idle', False):
+                    continue
+                frame = frames.get(thread.ident)
+                stack = []
+                while frame:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                # collapsed stack starts from the root frame
+                stack.reverse()
+                key = ';'.join(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def report(self, path):
+        """Write hot path report to path, collapsed stacks to path.collapsed.
+
+        The collapsed stack file can be fed to flamegraph.pl directly.
+        """
+        total = sum(self.stacks.values())
+        self_samples = {}
+        total_samples = {}
+        for key, count in self.stacks.items():
+            funcs = key.split(';')
+            self_samples[funcs[-1]] = self_samples.get(funcs[-1], 0) + count
+            # count recursive function only once per stack
+            for func in set(funcs):
+                total_samples[func] = total_samples.get(func, 0) + count
+        with open(path, 'w') as f:
+            f.write('%-24s %10s %12s %12s\n' %
+                    ('stage', 'calls', 'total(s)', 'mean(ms)'))
+            stages = sorted(self.timings.items(),
+                            key=lambda x: x[1][1], reverse=True)
+            for name, (calls, seconds) in stages:
+                f.write('%-24s %10d %12.3f %12.3f\n' %
+                        (name, calls, seconds, seconds * 1000 / calls))
+            f.write('\n%8s %8s  %s (%d samples)\n' %
+                    ('self%', 'total%', 'function', total))
+            funcs = sorted(total_samples.items(),
+                           key=lambda x: (self_samples.get(x[0], 0), x[1]),
+                           reverse=True)
+            for func, count in funcs:
+                f.write('%8.2f %8.2f  %s\n' %
+                        (100.0 * self_samples.get(func, 0) / total,
+                         100.0 * count / total, func))
+        with open(path + '.collapsed', 'w') as f:
+            for key, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (key, count))
+
+
+class PageSink(object):
+    """Interface of the place where crawled pages are stored.
+
+    SQLWorker hands the Page records to a sink one by one, a subclass
+    should implement dump_page at least. close is called when the
+    worker stops, so the sink can flush and release its resources.
+
+    stores_links tells whether dump_links keeps the link graph, the
+    spider doesn't send Links records to a sink which drops them.
+    """
+    stores_links = False
+
+    def prepare(self):
+        """Get ready before the first page, in the calling thread."""
+        pass
+
+    def dump_page(self, page):
+        """Store a Page."""
+        raise NotImplementedError()
+
+    def dump_links(self, links):
+        """Store a Links record, ignored unless the sink keeps graph."""
+        pass
+
+    def close(self):
+        """Flush and release resources held by the sink."""
+        pass
+
+
+class SQLiteSink(PageSink):
+    """Default sink, store pages into the pages table of sqlite3.
+
+    The link graph is stored too, every url gets an integer id in the
+    urls table, and each link is a (src, dst) row of ids in the links
+    table. Links are inserted in batches of link_batch rows.
+
+    The writing connection belongs to the sql worker thread, other
+    threads query the graph with a connection of their own. Queries
+    count the links waiting for the next batch too, but not the ones
+    still on their way in the output queue.
+    """
+    stores_links = True
+
+    def __init__(self, dbfile='/tmp/sample.db', logger=None,
+                 link_batch=1000):
+        """SQLiteSink init method.
+
+        param: dbfile where to store database
         param: logger logger object
+        param: link_batch Insert links when this many are pending
         """
-        Thread.__init__(self)
-        self.daemon = True
         self.dbfile = dbfile
-        self.in_queue = in_queue
         self.logger = logger or logging.getLogger(__name__)
+        self.link_batch = link_batch
+        self.pending_links = []
+        # in-degree of urls counting only pending links
+        self.pending_degrees = {}
+        self.lock = Lock()
         self.conn = None
+        # read connection of each querying thread
+        self.local = local()
+        self.readers = []
 
     def get_sql_connection(self, dbfile=None, need_table=True):
         """Get sql connection to dbfile.
@@ -148,6 +591,7 @@ class SQLWorker(Thread):
         # already init the connection, just return it
         if self.conn and not dbfile:
             return self.conn
+        import sqlite3
         db = dbfile or self.dbfile
         # it will create the dbfile if it doesn't exist
         self.conn = sqlite3.connect(db)
@@ -161,9 +605,9 @@ class SQLWorker(Thread):
         self.logger.info('Connected to sql done')
         return self.conn
 
-    def init_table(self, script=None):
-        """Init sqlite3 database table."""
-        conn = self.get_sql_connection(need_table=False)
+    def init_table(self, script=None, conn=None):
+        """Init sqlite3 database table, of the sink connection if None."""
+        conn = conn or self.get_sql_connection(need_table=False)
         curs = conn.cursor()
         s = script or """
                       CREATE TABLE IF NOT EXISTS pages(
@@ -171,26 +615,298 @@ class SQLWorker(Thread):
                       content,
                       last_modified,
                       etag,
-                      redirect);"""
+                      redirect);
+                      CREATE TABLE IF NOT EXISTS urls(
+                      id INTEGER PRIMARY KEY,
+                      url UNIQUE);
+                      CREATE TABLE IF NOT EXISTS links(
+                      src INTEGER,
+                      dst INTEGER);
+                      CREATE INDEX IF NOT EXISTS links_dst
+                      ON links(dst);"""
         curs.executescript(s)
         curs.close()
         self.logger.info('database Initialization done')
 
     def dump_page(self, page):
-        """Dump a page dict to sql."""
+        """Dump a Page to sql."""
         conn = self.conn or self.get_sql_connection()
         curs = conn.cursor()
-        self.logger.debug('dump %s' % page['url'])
+        self.logger.debug('dump %s' % page.url)
         # avoid sql injection
         curs.execute('INSERT INTO pages VALUES (?,?,?,?,?);',
-                     (page['url'],
-                      page['content'],
-                      page['lastmodified'],
-                      page['etag'],
-                      page['redirect']))
+                     (page.url,
+                      page.content,
+                      page.lastmodified,
+                      page.etag,
+                      page.redirect))
         conn.commit()
         curs.close()
 
+    def prepare(self):
+        """Create the tables, so other threads can query them at once.
+
+        A temporary connection is used, the sink connection must be
+        opened by the sql worker thread.
+        """
+        import sqlite3
+        conn = sqlite3.connect(self.dbfile)
+        self.init_table(conn=conn)
+        conn.close()
+
+    def dump_links(self, links):
+        """Queue the edges of a Links record, insert them in batch."""
+        self.logger.debug('dump %d links of %s' %
+                          (len(links.links), links.url))
+        with self.lock:
+            for link in links.links:
+                self.pending_links.append((links.url, link))
+                self.pending_degrees[link] = \
+                    self.pending_degrees.get(link, 0) + 1
+            full = len(self.pending_links) >= self.link_batch
+        if full:
+            self.flush_links()
+
+    def flush_links(self, chunk=500):
+        """Insert all pending links.
+
+        Urls of the batch are added with one executemany, then their
+        ids are fetched chunk urls per query, sqlite limits the count
+        of parameters of a query to 999. Only the thread owning the
+        sink connection, the sql worker, may call it.
+        """
+        with self.lock:
+            pending, self.pending_links = self.pending_links, []
+        if not pending:
+            return
+        conn = self.conn or self.get_sql_connection()
+        curs = conn.cursor()
+        urls = set()
+        for src, dst in pending:
+            urls.add(src)
+            urls.add(dst)
+        urls = list(urls)
+        curs.executemany('INSERT OR IGNORE INTO urls(url) VALUES (?);',
+                         ((url,) for url in urls))
+        ids = {}
+        for i in range(0, len(urls), chunk):
+            part = urls[i:i + chunk]
+            curs.execute('SELECT url, id FROM urls WHERE url IN (%s);' %
+                         ','.join('?' * len(part)), part)
+            ids.update(curs.fetchall())
+        curs.executemany('INSERT INTO links VALUES (?,?);',
+                         ((ids[src], ids[dst]) for src, dst in pending))
+        conn.commit()
+        curs.close()
+        # a query between commit and here counts these links twice,
+        # good enough for ordering the frontier
+        with self.lock:
+            for src, dst in pending:
+                degree = self.pending_degrees[dst] - 1
+                if degree:
+                    self.pending_degrees[dst] = degree
+                else:
+                    del self.pending_degrees[dst]
+
+    def get_read_connection(self):
+        """Get the connection of the calling thread to query the graph."""
+        conn = getattr(self.local, 'conn', None)
+        if conn:
+            return conn
+        import sqlite3
+        # closed by close(), which may run in another thread, the
+        # tables are created by prepare or the sink connection
+        conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+        self.local.conn = conn
+        with self.lock:
+            self.readers.append(conn)
+        return conn
+
+    def in_degree(self, url):
+        """Return count of crawled pages linking to url.
+
+        Pages dropped by the key filter are counted too, the graph
+        doesn't depend on the page content.
+        """
+        return self.in_degrees([url])[0]
+
+    def in_degrees(self, urls, chunk=500):
+        """Return list of in-degree of each url in urls.
+
+        Urls are counted chunk urls per query, the pending links are
+        added from memory.
+        """
+        degrees = {}
+        curs = self.get_read_connection().cursor()
+        for i in range(0, len(urls), chunk):
+            part = urls[i:i + chunk]
+            curs.execute('SELECT urls.url, COUNT(*) FROM links'
+                         ' JOIN urls ON links.dst = urls.id'
+                         ' WHERE urls.url IN (%s) GROUP BY links.dst;' %
+                         ','.join('?' * len(part)), part)
+            degrees.update(curs.fetchall())
+        curs.close()
+        with self.lock:
+            return [degrees.get(url, 0) + self.pending_degrees.get(url, 0)
+                    for url in urls]
+
+    def linking_to(self, url):
+        """Return urls of crawled pages linking to url."""
+        curs = self.get_read_connection().cursor()
+        curs.execute('SELECT src.url FROM links'
+                     ' JOIN urls dst ON links.dst = dst.id'
+                     ' JOIN urls src ON links.src = src.id'
+                     ' WHERE dst.url = ?;', (url,))
+        r = [row[0] for row in curs.fetchall()]
+        curs.close()
+        return r
+
+    def top_in_degree(self, count=10):
+        """Return [(url, in-degree)] of the count most linked urls.
+
+        It can be used to crawl the most linked pages first.
+        """
+        curs = self.get_read_connection().cursor()
+        curs.execute('SELECT urls.url, COUNT(*) AS degree FROM links'
+                     ' JOIN urls ON links.dst = urls.id'
+                     ' GROUP BY links.dst ORDER BY degree DESC LIMIT ?;',
+                     (count,))
+        r = curs.fetchall()
+        curs.close()
+        return r
+
+    def iter_pages(self, batch=1000):
+        """Yield Page records of the pages table.
+
+        Rows are fetched batch by batch, so the table is never loaded
+        into memory as a whole.
+        """
+        conn = self.conn or self.get_sql_connection()
+        curs = conn.cursor()
+        curs.execute('SELECT url, content, last_modified, etag, redirect'
+                     ' FROM pages;')
+        try:
+            while True:
+                rows = curs.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield Page(row[0], row[1], row[3], row[2], row[4])
+        finally:
+            curs.close()
+
+    def close(self):
+        if self.conn:
+            self.flush_links()
+            self.conn.close()
+            self.conn = None
+        with self.lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+            self.local = local()
+
+
+class SegmentSink(PageSink):
+    """Append-only sink writes pages to gzipped json lines segments.
+
+    Each line of a segment is a json object of one page. Once the
+    compressed size of the current segment reaches segment_size bytes,
+    it is closed and the next one is opened. Segments are named
+    pages-00000.jsonl.gz, pages-00001.jsonl.gz, ... and existing
+    segments in the directory are never overwritten.
+    """
+    def __init__(self,
+                 directory='/tmp/segments',
+                 segment_size=64 * 1024 * 1024,
+                 logger=None):
+        """SegmentSink init method.
+
+        param: directory where to store segments, created if missing
+        param: segment_size rotate segment when reaching this size
+        param: logger logger object
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.index = 0
+        self.rawfile = None
+        self.segment = None
+
+    def segment_path(self, index):
+        """Return path of the segment numbered index."""
+        return os.path.join(self.directory, 'pages-%05d.jsonl.gz' % index)
+
+    def open_segment(self):
+        """Close current segment and open the next one."""
+        import gzip
+        self.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # skip segments left by previous runs
+        while os.path.exists(self.segment_path(self.index)):
+            self.index += 1
+        path = self.segment_path(self.index)
+        self.rawfile = open(path, 'wb')
+        self.segment = gzip.GzipFile(fileobj=self.rawfile, mode='wb')
+        self.index += 1
+        self.logger.info('open segment %s' % path)
+        return self.segment
+
+    def dump_page(self, page):
+        """Append a Page to current segment."""
+        import json
+        segment = self.segment or self.open_segment()
+        self.logger.debug('dump %s' % page.url)
+        line = json.dumps({'url': page.url,
+                           'content': page.content,
+                           'last_modified': page.lastmodified,
+                           'etag': page.etag,
+                           'redirect': page.redirect})
+        segment.write(line)
+        segment.write('\n')
+        # the raw file only grows when gzip flushes its compressed
+        # buffer, but it is precise enough to decide the rotation
+        if self.rawfile.tell() >= self.segment_size:
+            self.close()
+
+    def close(self):
+        if self.segment:
+            # GzipFile doesn't close the fileobj passed in
+            self.segment.close()
+            self.rawfile.close()
+            self.segment = None
+            self.rawfile = None
+
+
+class SQLWorker(Thread):
+    def __init__(self,
+                 dbfile='/tmp/sample.db',
+                 in_queue=None,
+                 logger=None,
+                 sink=None):
+        """SQLWorker init method.
+
+        param: dbfile where to store database, used by default sink
+        param: in_queue where to get data
+        param: logger logger object
+        param: sink PageSink object, SQLiteSink of dbfile if None
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.dbfile = dbfile
+        self.in_queue = in_queue
+        self.logger = logger or logging.getLogger(__name__)
+        self.sink = sink or SQLiteSink(dbfile, self.logger)
+
+    def dump_page(self, page):
+        """Dump a Page to the sink."""
+        self.sink.dump_page(page)
+
+    def dump_links(self, links):
+        """Dump a Links record to the sink."""
+        self.sink.dump_links(links)
+
     def run(self):
         while True:
             try:
@@ -200,15 +916,54 @@ class SQLWorker(Thread):
                 if not page:
                     self.logger.info('sql worker receive stop signal')
                     break
-                self.dump_page(page)
+                if isinstance(page, Links):
+                    self.dump_links(page)
+                else:
+                    self.dump_page(page)
             except Empty, e:
                 continue
             except Exception, e:
+                # keep draining, or the producers blocked by the
+                # bounded queue will never wake up
                 self.logger.error('%s %s url=%s' %
                                   (e.__class__.__name__, e,
-                                   page['url']))
-                break
-        self.conn.close()
+                                   page.url))
+        self.sink.close()
+
+
+def export_pages(dbfile, sink, logger=None):
+    """Stream all pages stored in sqlite dbfile into sink.
+
+    Return the count of exported pages. Both the database and the
+    sink are closed when done. The database is only read, no table is
+    created in it, and IOError is raised if dbfile doesn't exist or
+    isn't a sqlite database with a pages table.
+    """
+    import sqlite3
+    if not dbfile or not os.path.isfile(dbfile):
+        raise IOError('database file %s does not exist' % dbfile)
+    source = SQLiteSink(dbfile, logger)
+    # connect without init_table, the source must stay untouched
+    conn = source.get_sql_connection(need_table=False)
+    try:
+        tables = conn.execute("SELECT name FROM sqlite_master"
+                              " WHERE type='table' AND name='pages';")
+        tables = tables.fetchall()
+    except sqlite3.DatabaseError:
+        # not a sqlite database at all
+        tables = []
+    if not tables:
+        source.close()
+        raise IOError('%s has no pages table' % dbfile)
+    count = 0
+    try:
+        for page in source.iter_pages():
+            sink.dump_page(page)
+            count += 1
+    finally:
+        source.close()
+        sink.close()
+    return count
 
 
 class Spider(object):
@@ -220,7 +975,16 @@ class Spider(object):
                  logfile=None, loglevel=None,
                  threads=1,
                  dbfile=None,
-                 key=''):
+                 key='',
+                 sink=None,
+                 frontier_high=10000,
+                 frontier_low=None,
+                 output_size=100,
+                 spill_dir=None,
+                 profile=None,
+                 link_graph=True,
+                 seen_memory=100000,
+                 frontier_order='fifo'):
         """init Spider but will not start automatically.
 
         param: url If scheme is not specified, http will be used
@@ -231,19 +995,54 @@ class Spider(object):
         param: threads Number of parallel thread to crawl page
         param: dbfile Path to sqlite3 database file
         param: key Regular expression to search page content
+        param: sink PageSink to store pages, sqlite3 dbfile if None
+        param: frontier_high Max urls to crawl kept in memory, the
+                             rest are spilled to disk
+        param: frontier_low Refill urls from disk when memory drops to
+                            it, half of frontier_high if None
+        param: output_size Max pages waiting to be stored, crawling
+                           threads block when it's full
+        param: spill_dir Directory for the frontier and crawled urls
+                         spill files
+        param: profile Path to write the profiling report, profiling
+                       is disabled if None
+        param: link_graph Whether to store out-links of crawled pages,
+                          ignored if the sink doesn't store links
+        param: seen_memory Max crawled urls kept in memory, the rest
+                           are spilled to disk
+        param: frontier_order 'fifo', or 'in-degree' to crawl urls in
+                              memory linked by more pages first, it
+                              needs a sink storing the link graph
         """
         self.logger = self.get_logger(logfile, loglevel)
         self.url_pattern = self.compile_url_pattern()
         self.key = self.get_key_pattern(key)
         self.url = self.get_abs_url(None, url)
         self.depth = depth
-        self.tasks_queue = Queue()
-        self.output_queue = Queue()
+        self.output_queue = Queue(output_size)
         self.pool = TreadPool(threads)
         self.sql_worker = SQLWorker(dbfile, self.output_queue,
-                                    self.logger)
-        self.progress_urls = []
+                                    self.logger, sink)
+        # don't fill the output queue with links the sink would drop
+        self.link_graph = link_graph and self.sql_worker.sink.stores_links
+        priority = None
+        if frontier_order == 'in-degree':
+            if not self.link_graph:
+                raise ValueError('in-degree order needs the link graph')
+            priority = self.sql_worker.sink.in_degrees
+        self.tasks_queue = FrontierQueue(frontier_high, frontier_low,
+                                         spill_dir, priority)
+        self.progress_urls = SeenSet(seen_memory, spill_dir)
         self.status_timer = Timer(10.0, self.print_status)
+        self.profile = profile
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler()
+            self.profiler.wrap(self, ('get_page',
+                                      'get_all_links',
+                                      'filter_links'))
+            self.profiler.wrap(self.sql_worker, ('dump_page',))
+            self.profiler.watch(self.pool.pool)
 
     def compile_url_pattern(self, pattern=None, verbose=None):
         """Compile a new url pattern.
@@ -298,11 +1097,15 @@ class Spider(object):
         # if depth is done then stop
         if depth <= 1:
             return
-        links = self.get_all_links(result['content'])
+        links = self.get_all_links(result.content)
         links = self.filter_links(links, url)
+        tasks = [Task(link, depth - 1) for link in links]
+        # keep parent to child relationship for the link graph
+        if self.link_graph:
+            self.output_queue.put(Links(url, [task.url for task in tasks]))
         # put links into queue
-        for link in links:
-            self.tasks_queue.put((link, depth - 1))
+        for task in tasks:
+            self.tasks_queue.put(task)
 
     def filter_links(self, links, parent=None):
         """Filter links
@@ -313,7 +1116,7 @@ class Spider(object):
         4. remove invalid urls
         """
         # remove urls' fragment
-        l = [urllib2.urlparse.urldefrag(link)[0]
+        l = [urlparse.urldefrag(link)[0]
              for link in links]
         # get urls' absolute url
         l = [self.get_abs_url(parent, link) for link in l]
@@ -326,7 +1129,7 @@ class Spider(object):
     def get_abs_url(self, base, url):
         """Get absolute address from url based on the base url.
 
-        Using urllib2.urlparse.urljoin(). Note, the result can be
+        Using urlparse.urljoin(). Note, the result can be
         unreachable!
 
         If base is not a valid url can be accessed via urllib2, then
@@ -344,18 +1147,19 @@ class Spider(object):
         if base and not self.is_valid_url(base):
             self.logger.warn('invalid base url %s' % base)
             base = None
-        abs_url = urllib2.urlparse.urljoin(base, url)
+        abs_url = urlparse.urljoin(base, url)
         if not self.is_valid_url(abs_url):
             # only try the http scheme, ignore the https case
             self.logger.warn('missing scheme for %s, set to http' %
                              abs_url)
-            pr = urllib2.urlparse.urlparse(abs_url)
+            pr = urlparse.urlparse(abs_url)
             if not pr.scheme:
                 abs_url = ''.join(('http://', abs_url))
         return abs_url
 
     def get_all_links(self, content):
         """Get all links from content's 'a' tags."""
+        import BeautifulSoup
         soup = BeautifulSoup.BeautifulSoup(content)
         links = []
         for link in soup('a'):
@@ -406,6 +1210,7 @@ class Spider(object):
 
     def get_page(self, url):
         """Get content from page and safely close the connection."""
+        import urllib2
         try:
             req = urllib2.Request(url)
             # using gzip to accelerate
@@ -413,21 +1218,22 @@ class Spider(object):
             opener = urllib2.build_opener()
             page = opener.open(req, None, timeout=30)
             try:
-                result = self.verify_page_headers(page.headers)
-                result['content'] = self.get_page_content(page)
+                headers = self.verify_page_headers(page.headers)
+                content = self.get_page_content(page)
             except Exception, e:
                 page.close()
                 raise e
-            result['url'] = url
             # this url has been redirected, what's up?
             if hasattr(page, 'url'):
-                result['redirect'] = page.url
+                redirect = page.url
             else:
-                result['redirect'] = ''
+                redirect = ''
             page.close()
+            result = Page(url, content, headers['etag'],
+                          headers['lastmodified'], redirect)
             # if key is defined, then only dump page contains key
             if self.key:
-                if self.key.search(result['content']):
+                if self.key.search(result.content):
                     self.output_queue.put(result)
             else:
                 self.output_queue.put(result)
@@ -446,6 +1252,8 @@ class Spider(object):
         """
         # unpack gzip file
         if page.headers.get('content-encoding', '') == 'gzip':
+            import gzip
+            import StringIO
             page_content = page.read()
             fileobj = StringIO.StringIO(page_content)
             zipfile = gzip.GzipFile(fileobj=fileobj)
@@ -476,14 +1284,19 @@ class Spider(object):
         print 'start at %s' % time.strftime('%Y-%m-%d %H:%M:%S')
         self.logger.info('task start from %s with depth %s' %
                          (self.url, self.depth))
+        if self.tasks_queue.priority:
+            # the frontier queries the graph before any page is written
+            self.sql_worker.sink.prepare()
         self.sql_worker.start()
         self.status_timer.start()
-        self.tasks_queue.put((self.url, self.depth))
+        if self.profiler:
+            self.profiler.start()
+        self.tasks_queue.put(Task(self.url, self.depth))
         try:
             while True:
                 try:
                     # block for 1 second
-                    url, depth = self.tasks_queue.get(True, 1)
+                    task = self.tasks_queue.get(True, 1)
                 except Empty, e:
                     # oops, some task is not done yet
                     if self.pool.undone_tasks():
@@ -496,9 +1309,9 @@ class Spider(object):
                         # break out to finally block
                         break
                 # avoid reduplicated urls
-                if not url in self.progress_urls:
-                    self.pool.spawn(self.crawl_page, *(url, depth))
-                    self.progress_urls.append(url)
+                if task.url not in self.progress_urls:
+                    self.pool.spawn(self.crawl_page, task.url, task.depth)
+                    self.progress_urls.add(task.url)
         except Exception, e:
             self.logger.critical('%s %s' % (e.__class__.__name__, e))
         finally:
@@ -508,8 +1321,18 @@ class Spider(object):
             self.sql_worker.join()
             # stop timer
             self.status_timer.cancel()
+            count = len(self.progress_urls)
+            # remove the spill files before anything else may fail
+            try:
+                self.tasks_queue.close()
+            finally:
+                self.progress_urls.close()
+            if self.profiler:
+                self.profiler.stop()
+                self.profiler.report(self.profile)
+                print 'profile written to %s' % self.profile
             print 'stop at %s' % time.strftime('%Y-%m-%d %H:%M:%S')
-            print 'process url count=%d' % len(self.progress_urls)
+            print 'process url count=%d' % count
             self.logger.info('task done!')
 
     def verify_page_headers(self, headers):
@@ -529,6 +1352,7 @@ class Spider(object):
 
 
 def main(argv=sys.argv[1:]):
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', '--url',
                         help='valid url for spider')
@@ -546,11 +1370,38 @@ def main(argv=sys.argv[1:]):
                         help='parallel thread to grab data')
     parser.add_argument('--dbfile', help='file path for sqlite')
     parser.add_argument('--key', help='filter key for page content')
+    parser.add_argument('--sink', choices=('sqlite', 'segment'),
+                        default='sqlite',
+                        help='where to store pages, sqlite by default')
+    parser.add_argument('--segment-dir', default='/tmp/segments',
+                        help='directory for gzipped json lines segments')
+    parser.add_argument('--segment-size', type=int,
+                        default=64 * 1024 * 1024,
+                        help='rotate segment when reaching this bytes')
+    parser.add_argument('--export', action='store_true',
+                        help='export pages of dbfile to segments, exit')
+    parser.add_argument('--frontier-high', type=int, default=10000,
+                        help='max urls in memory, the rest go to disk')
+    parser.add_argument('--frontier-low', type=int,
+                        help='refill urls from disk below this count')
+    parser.add_argument('--output-size', type=int, default=100,
+                        help='max pages waiting to be stored')
+    parser.add_argument('--spill-dir', help='directory for spilled urls')
+    parser.add_argument('--seen-memory', type=int, default=100000,
+                        help='max crawled urls in memory, the rest go to disk')
+    parser.add_argument('--profile', nargs='?', const='/tmp/spider.profile',
+                        help='write hot path report and collapsed stacks')
+    parser.add_argument('--no-link-graph', action='store_true',
+                        help='do not store links between pages')
+    parser.add_argument('--frontier-order', choices=('fifo', 'in-degree'),
+                        default='fifo',
+                        help='crawl most linked urls first by in-degree')
     args = parser.parse_args(argv)
     if args.testself:
         # i don't like doctest because it is fool to add test in codes
         # i know the following code is fool too, but i think it's
         # better to use unittest than doctest
+        import unittest
         source_dir = os.path.dirname(os.path.abspath(__file__))
         root_dir = os.path.dirname(source_dir)
         sys.path.append(root_dir)
@@ -558,12 +1409,45 @@ def main(argv=sys.argv[1:]):
         suite = unittest.TestLoader().loadTestsFromModule(
             test_spider)
         unittest.TextTestRunner(verbosity=2).run(suite)
+        return
+    if args.frontier_high < 1:
+        parser.error('--frontier-high must be at least 1')
+    if args.frontier_low is not None and \
+            not 0 <= args.frontier_low < args.frontier_high:
+        parser.error('--frontier-low must be in [0, --frontier-high)')
+    if args.frontier_order == 'in-degree' and \
+            (args.sink != 'sqlite' or args.no_link_graph):
+        parser.error('--frontier-order in-degree needs the link graph'
+                     ' of the sqlite sink')
+    if args.seen_memory < 1:
+        parser.error('--seen-memory must be at least 1')
+    if args.export and not args.dbfile:
+        parser.error('--export requires --dbfile')
+    sink = None
+    if args.sink == 'segment' or args.export:
+        sink = SegmentSink(args.segment_dir, args.segment_size)
+    if args.export:
+        try:
+            count = export_pages(args.dbfile, sink)
+        except IOError, e:
+            parser.error(str(e))
+        print 'export page count=%d' % count
+        return
     spider = Spider(url=args.url,
                     depth=args.depth,
                     logfile=args.logfile, loglevel=args.loglevel,
                     threads=args.thread,
                     dbfile=args.dbfile,
-                    key=args.key)
+                    key=args.key,
+                    sink=sink,
+                    frontier_high=args.frontier_high,
+                    frontier_low=args.frontier_low,
+                    output_size=args.output_size,
+                    spill_dir=args.spill_dir,
+                    profile=args.profile,
+                    link_graph=not args.no_link_graph,
+                    seen_memory=args.seen_memory,
+                    frontier_order=args.frontier_order)
     spider.start()
 
 
@@ -24,6 +24,12 @@ import unittest
 import logging
 import Queue
 import sqlite3
+import gzip
+import json
+import shutil
+import tempfile
+import time
+import threading
 import pep8
 
 TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -31,7 +37,9 @@ ROOT_DIR = os.path.dirname(TESTS_DIR)
 SOURCE_DIR = os.path.join(ROOT_DIR, 'spider')
 if not SOURCE_DIR in sys.path:
     sys.path.append(SOURCE_DIR)
-from spider import Spider, SQLWorker
+from spider import (Spider, SQLWorker, SQLiteSink, SegmentSink, FrontierQueue,
+                    SeenSet, Profiler, Task, Page, Links, intern_url,
+                    export_pages)
 
 
 class PEP8Test(unittest.TestCase):
@@ -187,28 +195,96 @@ class SpiderTest(unittest.TestCase):
         r = k.search(u'我是测试')
         self.assertNotEqual(r, None)
 
+    def test_start_remove_spill_files(self):
+        spill_dir = tempfile.mkdtemp()
+        spider = Spider('http://127.0.0.1:1/', loglevel=1,
+                        dbfile='/tmp/test.db', seen_memory=1,
+                        spill_dir=spill_dir,
+                        profile='/nonexistent/test.profile')
+        self.assertRaises(IOError, spider.start)
+        files = os.listdir(spill_dir)
+        shutil.rmtree(spill_dir)
+        self.assertEqual(files, [])
+
+    def test_link_graph_follow_sink(self):
+        self.assertTrue(self.spider.link_graph)
+        spider = Spider('http://www.google.com', loglevel=1,
+                        sink=SegmentSink())
+        self.assertFalse(spider.link_graph)
+
+    def test_frontier_order(self):
+        self.assertEqual(self.spider.tasks_queue.priority, None)
+        spider = Spider('http://www.google.com', loglevel=1,
+                        frontier_order='in-degree')
+        self.assertEqual(spider.tasks_queue.priority,
+                         spider.sql_worker.sink.in_degrees)
+        self.assertRaises(ValueError, Spider, 'http://www.google.com',
+                          loglevel=1, link_graph=False,
+                          frontier_order='in-degree')
+
+    def test_frontier_order_by_links(self):
+        dbfile = tempfile.mktemp(suffix='.db')
+        spider = Spider('http://www.google.com', loglevel=1,
+                        dbfile=dbfile, frontier_order='in-degree')
+        sink = spider.sql_worker.sink
+        sink.prepare()
+        self.assertEqual(sink.link_batch, 1000)
+        # flushed and pending links both count
+        spider.sql_worker.dump_links(Links('p1', ['z']))
+        spider.sql_worker.dump_links(Links('p4', ['z']))
+        sink.flush_links()
+        spider.sql_worker.dump_links(Links('p1', ['x', 'y']))
+        spider.sql_worker.dump_links(Links('p2', ['y', 'z']))
+        spider.sql_worker.dump_links(Links('p3', ['y', 'z']))
+        for url in ('w', 'x', 'y', 'z'):
+            spider.tasks_queue.put(Task(url, 1))
+        r = [spider.tasks_queue.get(False).url for i in range(4)]
+        spider.tasks_queue.close()
+        sink.close()
+        os.remove(dbfile)
+        self.assertEqual(r, ['z', 'y', 'x', 'w'])
+
+
+class RecordTest(unittest.TestCase):
+    def test_intern_url(self):
+        url = intern_url(u'http://www.google.com/' + u'a')
+        self.assertTrue(isinstance(url, str))
+        self.assertTrue(url is intern_url('http://www.google.com/a'))
+
+    def test_intern_url_non_ascii(self):
+        url = intern_url(u'http://a/测试')
+        self.assertEqual(url, u'http://a/测试')
+
+    def test_task_share_url(self):
+        t1 = Task(u'http://a/b', 1)
+        t2 = Task(''.join(('http://a/', 'b')), 2)
+        self.assertTrue(t1.url is t2.url)
+
+    def test_slots(self):
+        self.assertRaises(AttributeError, setattr, Task('a', 1), 'x', 1)
+        self.assertRaises(AttributeError, setattr, Page('a', 'b'), 'x', 1)
+
 
 class SQLWorkerTest(unittest.TestCase):
     def setUp(self):
         self.queue = Queue.Queue()
         self.sql = SQLWorker(dbfile='/tmp/test.db',
                              in_queue=self.queue)
-        self.conn = self.sql.get_sql_connection()
+        self.conn = self.sql.sink.get_sql_connection()
 
     def tearDown(self):
         self.conn.close()
         os.remove('/tmp/test.db')
 
     def test_get_sql_connection(self):
-        conn = self.sql.get_sql_connection('/tmp/test2.db')
+        conn = self.sql.sink.get_sql_connection('/tmp/test2.db')
         self.assertNotEqual(conn, None)
         conn.close()
         os.remove('/tmp/test2.db')
 
     def test_dump_page(self):
-        page = {'url': '1', 'content': '2', 'lastmodified': '3',
-                'etag': '4', 'redirect': '5'}
-        self.sql.get_sql_connection('/tmp/test.db')
+        page = Page('1', '2', lastmodified='3', etag='4', redirect='5')
+        self.sql.sink.get_sql_connection('/tmp/test.db')
         self.sql.dump_page(page)
         conn = sqlite3.connect('/tmp/test.db')
         curs = conn.cursor()
@@ -218,6 +294,373 @@ class SQLWorkerTest(unittest.TestCase):
         conn.close()
         self.assertEqual(a, (u'4',))
 
+    def test_iter_pages(self):
+        page = Page('1', '2', lastmodified='3', etag='4', redirect='5')
+        self.sql.dump_page(page)
+        self.sql.dump_page(page)
+        pages = list(self.sql.sink.iter_pages(batch=1))
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[0].etag, u'4')
+        self.assertEqual(pages[0].lastmodified, u'3')
+
+    def test_dump_links(self):
+        self.sql.dump_links(Links('a', ['b', 'c']))
+        self.sql.dump_links(Links('b', ['c']))
+        sink = self.sql.sink
+        self.assertEqual(len(sink.pending_links), 3)
+        self.assertEqual(sink.in_degree('c'), 2)
+        sink.flush_links()
+        self.assertEqual(sink.pending_links, [])
+        self.assertEqual(sink.pending_degrees, {})
+        self.assertEqual(sink.in_degree('c'), 2)
+        self.assertEqual(sink.in_degree('a'), 0)
+        self.assertEqual(sink.in_degree('x'), 0)
+        self.assertEqual(sorted(sink.linking_to('c')), [u'a', u'b'])
+        self.assertEqual(sink.linking_to('a'), [])
+        self.assertEqual(sink.top_in_degree(1), [(u'c', 2)])
+
+    def test_query_from_another_thread(self):
+        self.sql.dump_links(Links('a', ['b']))
+        self.sql.sink.flush_links()
+        r = []
+        thread = threading.Thread(
+            target=lambda: r.append(self.sql.sink.in_degree('b')))
+        thread.start()
+        thread.join()
+        self.assertEqual(r, [1])
+        self.assertEqual(len(self.sql.sink.readers), 1)
+        self.sql.sink.close()
+        self.assertEqual(self.sql.sink.readers, [])
+
+    def test_dump_links_batch(self):
+        self.sql.sink.link_batch = 2
+        self.sql.dump_links(Links('a', ['b']))
+        self.assertEqual(len(self.sql.sink.pending_links), 1)
+        self.sql.dump_links(Links('b', ['a']))
+        self.assertEqual(self.sql.sink.pending_links, [])
+        conn = sqlite3.connect('/tmp/test.db')
+        curs = conn.cursor()
+        curs.execute('select count(*) from links;')
+        a = curs.fetchone()
+        curs.execute('select count(*) from urls;')
+        b = curs.fetchone()
+        curs.close()
+        conn.close()
+        self.assertEqual((a, b), ((2,), (2,)))
+
+    def test_flush_links_chunk(self):
+        links = ['http://a/%d' % i for i in range(7)]
+        self.sql.dump_links(Links('http://a/0', links))
+        self.sql.dump_links(Links(u'http://a/测试', links[:2]))
+        self.sql.sink.flush_links(chunk=2)
+        self.assertEqual(self.sql.sink.in_degree('http://a/1'), 2)
+        self.assertEqual(self.sql.sink.in_degree('http://a/1'), 2)
+        self.assertEqual(self.sql.sink.in_degree('http://a/6'), 1)
+        self.assertEqual(self.sql.sink.linking_to('http://a/0'),
+                         [u'http://a/0', u'http://a/测试'])
+
+    def test_in_degrees(self):
+        links = ['http://a/%d' % i for i in range(7)]
+        self.sql.dump_links(Links('http://a/0', links))
+        self.sql.sink.flush_links()
+        self.sql.dump_links(Links('http://a/1', links[:2]))
+        r = self.sql.sink.in_degrees(['http://a/1', 'http://a/6', 'x'],
+                                     chunk=2)
+        self.assertEqual(r, [2, 1, 0])
+
+    def test_prepare(self):
+        dbfile = tempfile.mktemp(suffix='.db')
+        sink = SQLiteSink(dbfile)
+        sink.prepare()
+        r = []
+        thread = threading.Thread(
+            target=lambda: r.append(sink.in_degree('a')))
+        thread.start()
+        thread.join()
+        sink.close()
+        os.remove(dbfile)
+        self.assertEqual(r, [0])
+
+    def test_run_dispatch_and_flush(self):
+        self.queue.put(Links('a', ['b']))
+        self.queue.put(Page('a', 'c'))
+        self.queue.put(None)
+        self.sql.run()
+        self.conn = sqlite3.connect('/tmp/test.db')
+        curs = self.conn.cursor()
+        curs.execute('select count(*) from links;')
+        a = curs.fetchone()
+        curs.execute('select count(*) from pages;')
+        b = curs.fetchone()
+        curs.close()
+        self.assertEqual((a, b), ((1,), (1,)))
+
+
+class SegmentSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = '/tmp/test_segments'
+        self.sink = SegmentSink(self.directory, segment_size=1)
+        self.page = Page('1', u'测试', lastmodified='3', etag='4',
+                         redirect='5')
+
+    def tearDown(self):
+        self.sink.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def read_segment(self, index):
+        f = gzip.open(self.sink.segment_path(index))
+        lines = f.readlines()
+        f.close()
+        return [json.loads(line) for line in lines]
+
+    def test_dump_page(self):
+        self.sink.dump_page(self.page)
+        self.sink.close()
+        pages = self.read_segment(0)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0]['content'], u'测试')
+        self.assertEqual(pages[0]['last_modified'], '3')
+
+    def test_rotate_segment(self):
+        # gzip header alone exceeds 1 byte, so each page rotates
+        self.sink.dump_page(self.page)
+        self.sink.dump_page(self.page)
+        self.assertEqual(len(self.read_segment(0)), 1)
+        self.assertEqual(len(self.read_segment(1)), 1)
+
+    def test_not_overwrite_segment(self):
+        self.sink.dump_page(self.page)
+        sink = SegmentSink(self.directory)
+        sink.dump_page(self.page)
+        sink.close()
+        self.assertEqual(len(self.read_segment(1)), 1)
+
+    def test_export_pages(self):
+        sql = SQLWorker(dbfile='/tmp/test.db')
+        sql.dump_page(self.page)
+        sql.dump_page(self.page)
+        sql.sink.close()
+        sink = SegmentSink(self.directory)
+        count = export_pages('/tmp/test.db', sink)
+        os.remove('/tmp/test.db')
+        self.assertEqual(count, 2)
+        self.assertEqual(len(self.read_segment(0)), 2)
+
+    def test_export_pages_untouched_source(self):
+        conn = sqlite3.connect('/tmp/test.db')
+        conn.execute('create table pages(url, content, last_modified,'
+                     ' etag, redirect);')
+        conn.close()
+        count = export_pages('/tmp/test.db', self.sink)
+        conn = sqlite3.connect('/tmp/test.db')
+        tables = conn.execute('select name from sqlite_master'
+                              " where type='table';").fetchall()
+        conn.close()
+        os.remove('/tmp/test.db')
+        self.assertEqual(count, 0)
+        self.assertEqual(tables, [(u'pages',)])
+
+    def test_export_pages_missing_source(self):
+        self.assertRaises(IOError, export_pages, '/tmp/test_missing.db',
+                          self.sink)
+        self.assertRaises(IOError, export_pages, None, self.sink)
+
+    def test_export_pages_invalid_source(self):
+        conn = sqlite3.connect('/tmp/test.db')
+        conn.execute('create table other(a);')
+        conn.close()
+        self.assertRaises(IOError, export_pages, '/tmp/test.db', self.sink)
+        with open('/tmp/test.db', 'w') as f:
+            f.write('not a database' * 100)
+        self.assertRaises(IOError, export_pages, '/tmp/test.db', self.sink)
+        os.remove('/tmp/test.db')
+        self.assertFalse(os.path.exists('/tmp/test_missing.db'))
+
+
+class FrontierQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = FrontierQueue(high_watermark=4, low_watermark=1)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def test_invalid_watermarks(self):
+        self.assertRaises(ValueError, FrontierQueue, 0)
+        self.assertRaises(ValueError, FrontierQueue, 4, 4)
+        self.assertRaises(ValueError, FrontierQueue, 4, -1)
+        self.assertEqual(FrontierQueue(1).low_watermark, 0)
+
+    def test_get_empty(self):
+        self.assertRaises(Queue.Empty, self.queue.get, False)
+        self.assertRaises(Queue.Empty, self.queue.get, True, 0.01)
+
+    def test_spill_keep_order(self):
+        tasks = [(u'http://a/%d' % i, i) for i in range(10)]
+        for url, depth in tasks:
+            self.queue.put(Task(url, depth))
+        self.assertEqual(len(self.queue.memory), 4)
+        self.assertEqual(self.queue.qsize(), 10)
+        r = [self.queue.get(False) for i in range(10)]
+        self.assertEqual([(t.url, t.depth) for t in r], tasks)
+        self.assertEqual(self.queue.qsize(), 0)
+        self.assertEqual(os.path.getsize(self.queue.spill_path), 0)
+
+    def test_spill_interleaved(self):
+        r = []
+        for i in range(20):
+            self.queue.put(Task(u'http://a/%d' % i, 1))
+            if i % 3 == 0:
+                r.append(self.queue.get(False).url)
+        while self.queue.qsize():
+            r.append(self.queue.get(False).url)
+        self.assertEqual(r, [u'http://a/%d' % i for i in range(20)])
+
+    def test_spill_after_drained(self):
+        for n in (10, 3, 20, 100):
+            urls = [u'http://a/%s' % ('x' * (i % 7 + n)) for i in range(n)]
+            for url in urls:
+                self.queue.put(Task(url, 1))
+            r = [self.queue.get(False).url for url in urls]
+            self.assertEqual(r, urls)
+
+    def test_priority(self):
+        queue = FrontierQueue(high_watermark=3, low_watermark=1,
+                              priority=lambda urls: map(len, urls))
+        for url in ('http://a', 'http://bbb', 'http://cc', 'http://d',
+                    'http://eeeee'):
+            queue.put(Task(url, 1))
+        r = [queue.get(False).url for i in range(5)]
+        queue.close()
+        # the last two are spilled, they compete once read back when
+        # memory drops to the low watermark
+        self.assertEqual(r, ['http://bbb', 'http://cc', 'http://eeeee',
+                             'http://a', 'http://d'])
+
+    def test_priority_refill_in_one_call(self):
+        calls = []
+
+        def priority(urls):
+            calls.append(len(urls))
+            return [0] * len(urls)
+        queue = FrontierQueue(high_watermark=3, low_watermark=0,
+                              priority=priority)
+        for i in range(6):
+            queue.put(Task('http://a/%d' % i, 1))
+        r = [queue.get(False).url for i in range(6)]
+        queue.close()
+        self.assertEqual(r, ['http://a/%d' % i for i in range(6)])
+        self.assertEqual(calls, [1] * 6 + [3])
+
+    def test_priority_fifo_for_same(self):
+        queue = FrontierQueue(priority=lambda urls: [0] * len(urls))
+        for i in range(5):
+            queue.put(Task('http://a/%d' % i, 1))
+        r = [queue.get(False).url for i in range(5)]
+        self.assertEqual(r, ['http://a/%d' % i for i in range(5)])
+
+    def test_spill_special_url(self):
+        for i in range(5):
+            self.queue.put(Task(u'http://a/测 试\n', 2))
+        r = [self.queue.get(False) for i in range(5)]
+        self.assertEqual(r[-1].url, u'http://a/测 试%0A')
+        self.assertEqual(r[-1].depth, 2)
+
+    def test_close_remove_spill_file(self):
+        for i in range(5):
+            self.queue.put(Task('http://a', 1))
+        path = self.queue.spill_path
+        self.queue.close()
+        self.assertFalse(os.path.exists(path))
+
+
+class SeenSetTest(unittest.TestCase):
+    def setUp(self):
+        self.seen = SeenSet(memory_size=3)
+
+    def tearDown(self):
+        self.seen.close()
+
+    def test_invalid_memory_size(self):
+        self.assertRaises(ValueError, SeenSet, 0)
+
+    def test_in_memory(self):
+        self.seen.add('http://a')
+        self.assertTrue('http://a' in self.seen)
+        self.assertFalse('http://b' in self.seen)
+        self.assertEqual(self.seen.conn, None)
+
+    def test_spill(self):
+        urls = ['http://a/%d' % i for i in range(10)] + [u'http://a/测试']
+        for url in urls:
+            self.seen.add(url)
+        self.assertTrue(len(self.seen.memory) < 3)
+        self.assertEqual(len(self.seen), 11)
+        for url in urls:
+            self.assertTrue(url in self.seen)
+        self.assertFalse('http://a/10' in self.seen)
+
+    def test_spill_duplicated(self):
+        for url in ('http://a', 'http://b', 'http://c', 'http://a',
+                    'http://d', 'http://e'):
+            self.seen.add(url)
+        self.assertEqual(len(self.seen.memory), 0)
+        self.assertEqual(len(self.seen), 5)
+
+    def test_close_remove_spill_file(self):
+        for i in range(3):
+            self.seen.add('http://a/%d' % i)
+        path = self.seen.spill_path
+        self.seen.close()
+        self.assertFalse(os.path.exists(path))
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = Profiler(interval=0.001)
+        self.path = '/tmp/test.profile'
+
+    def tearDown(self):
+        for path in (self.path, self.path + '.collapsed'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def busy(self, seconds):
+        end = time.time() + seconds
+        while time.time() < end:
+            pass
+
+    def test_wrap(self):
+        spider = Spider('http://www.google.com', loglevel=1)
+        spider.logger.handlers = []
+        self.profiler.wrap(spider, ('filter_links',))
+        r = spider.filter_links(['http://a#b'])
+        spider.filter_links([])
+        self.assertEqual(r, ['http://a'])
+        self.assertEqual(self.profiler.timings['filter_links'][0], 2)
+
+    def test_sample_and_report(self):
+        thread = threading.Thread(target=self.busy, args=(0.2,))
+        self.profiler.watch([thread])
+        thread.start()
+        self.profiler.start()
+        thread.join()
+        self.profiler.stop()
+        self.profiler.record('busy', 0.2)
+        self.profiler.report(self.path)
+        self.assertTrue(self.profiler.stacks)
+        with open(self.path) as f:
+            report = f.read()
+        self.assertTrue('test_spider.py:busy' in report)
+        with open(self.path + '.collapsed') as f:
+            line = f.readline().strip()
+        self.assertTrue(re.match(r'^\S+;\S+ \d+$', line))
+
+    def test_disabled(self):
+        spider = Spider('http://www.google.com', loglevel=1)
+        spider.logger.handlers = []
+        self.assertEqual(spider.profiler, None)
+        self.assertFalse('get_page' in spider.__dict__)
+
 
 if __name__ == '__main__':
     unittest.main()